@@ -20,6 +20,19 @@ class FeatureTableWriter(object):
         line = "%s %s;" % (key, str(value))
         self.addLine(line)
 
+    def addLinesWithKeyValues(self, pairs):
+        """
+        Adds a line for each (key, value) pair
+        with form::
+
+            key value;
+        """
+        indentation = self._indentation
+        self._lines.extend(
+            "%s%s %s;" % (indentation, key, str(value))
+            for key, value in pairs
+        )
+
     def addLine(self, line):
         """
         Adds a raw line.
@@ -14,13 +14,23 @@ import os
 import time
 import datetime
 import calendar
+import functools
+import operator
+import types
 import unicodedata
-from fontTools.misc.textTools import binary2num
+import weakref
 from fontTools.misc.arrayTools import unionRect
 from fontTools.cffLib.width import optimizeWidths
 from fontTools import ufoLib
 
 
+# module-local bindings for functions called in tight
+# build loops; skips the module attribute lookups
+_gmtime = time.gmtime
+_strftime = time.strftime
+_timegm = calendar.timegm
+
+
 def _ignoreASCII(s):
     return s.encode("ascii", "ignore").decode()
 
@@ -47,7 +57,15 @@ def styleMapFamilyNameFallback(info):
 # head
 
 def dateStringForNow():
-    return time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime())
+    return _strftime("%Y/%m/%d %H:%M:%S", _gmtime())
+
+
+@functools.lru_cache(maxsize=1)
+def _dateStringForSourceDateEpoch():
+    if "SOURCE_DATE_EPOCH" not in os.environ:
+        return None
+    t = datetime.datetime.utcfromtimestamp(int(os.environ["SOURCE_DATE_EPOCH"]))
+    return t.strftime("%Y/%m/%d %H:%M:%S")
 
 
 def openTypeHeadCreatedFallback(info):
@@ -55,11 +73,9 @@ def openTypeHeadCreatedFallback(info):
     Fallback to the environment variable SOURCE_DATE_EPOCH if set, otherwise
     now.
     """
-    if "SOURCE_DATE_EPOCH" in os.environ:
-        t = datetime.utcfromtimestamp(int(os.environ["SOURCE_DATE_EPOCH"]))
-        return t.strftime("%Y/%m/%d %H:%M:%S")
-    else:
-        return dateStringForNow()
+    # SOURCE_DATE_EPOCH doesn't change while the process
+    # is running, so only read and format it once.
+    return _dateStringForSourceDateEpoch() or dateStringForNow()
 
 
 # hhea
@@ -86,7 +102,7 @@ def openTypeNameVersionFallback(info):
     """
     versionMajor = getAttrWithFallback(info, "versionMajor")
     versionMinor = getAttrWithFallback(info, "versionMinor")
-    return "%d.%s" % (versionMajor, str(versionMinor).zfill(3))
+    return f"{int(versionMajor):d}.{int(versionMinor):03d}"
 
 
 def openTypeNameUniqueIDFallback(info):
@@ -153,21 +169,27 @@ def openTypeOS2TypoDescenderFallback(info):
     return int(round(info.descender))
 
 
+def _fontBoundsForInfo(info):
+    # resolve the font once so the two fallbacks below
+    # share one parent resolution and one (cached)
+    # bounds calculation
+    font = getattr(info, "font", None)
+    if font is None:
+        return None
+    return getFontBounds(font)
+
+
 def openTypeOS2WinAscentFallback(info):
     """
     Fallback to the maximum y value of the font's bounding box.
     If that is not available, fallback to *ascender*.
     If the maximum y value is negative, fallback to 0 (zero).
     """
-    font = info.font
-    if font is None:
+    bounds = _fontBoundsForInfo(info)
+    if bounds is None:
         yMax = getAttrWithFallback(info, "ascender")
     else:
-        bounds = getFontBounds(font)
-        if bounds is not None:
-            xMin, yMin, xMax, yMax = bounds
-        else:
-            yMax = getAttrWithFallback(info, "ascender")
+        xMin, yMin, xMax, yMax = bounds
     if yMax < 0:
         return 0
     return yMax
@@ -179,10 +201,7 @@ def openTypeOS2WinDescentFallback(info):
     If that is not available, fallback to *descender*.
     If the mininum y value is positive, fallback to 0 (zero).
     """
-    font = info.font
-    if font is None:
-        return abs(getAttrWithFallback(info, "descender"))
-    bounds = getFontBounds(font)
+    bounds = _fontBoundsForInfo(info)
     if bounds is None:
         return abs(getAttrWithFallback(info, "descender"))
     xMin, yMin, xMax, yMax = bounds
@@ -194,43 +213,63 @@ def openTypeOS2WinDescentFallback(info):
 # postscript
 
 _postscriptFontNameExceptions = set("[](){}<>/%")
-_postscriptFontNameAllowed = set([chr(i) for i in range(33, 137)])
+_postscriptFontNameDeleteTable = str.maketrans("", "", "".join(sorted(_postscriptFontNameExceptions)))
+# the 128-136 slice of the historically allowed
+# range(33, 137): not ASCII, but passed through
+# untouched rather than decomposed
+_postscriptFontNamePassthrough = frozenset(chr(i) for i in range(128, 137))
 
 
 def normalizeStringForPostscript(s, allowSpaces=True):
     s = str(s)
-    normalized = []
-    for c in s:
-        if c == " " and not allowSpaces:
-            continue
-        if c in _postscriptFontNameExceptions:
-            continue
-        if c not in _postscriptFontNameAllowed:
-            c = _ignoreASCII(unicodedata.normalize("NFKD", c))
-        normalized.append(c)
-    return "".join(normalized)
+    if not allowSpaces:
+        s = s.replace(" ", "")
+    s = s.translate(_postscriptFontNameDeleteTable)
+    # the common case: nothing needs to be decomposed
+    if s.isascii():
+        return s
+    # characters in the passthrough range must survive
+    # unchanged, so handle strings containing them one
+    # character at a time
+    if not _postscriptFontNamePassthrough.isdisjoint(s):
+        return "".join(
+            c if c.isascii() or c in _postscriptFontNamePassthrough
+            else _ignoreASCII(unicodedata.normalize("NFKD", c))
+            for c in s
+        )
+    # quick check: skip the decomposition when the string
+    # is already in NFKD form
+    if not unicodedata.is_normalized("NFKD", s):
+        s = unicodedata.normalize("NFKD", s)
+    return _ignoreASCII(s)
 
 
 def normalizeNameForPostscript(name):
     return normalizeStringForPostscript(name, allowSpaces=False)
 
 
+def _preferredFamilyAndSubfamilyNames(info):
+    familyName = getAttrWithFallback(info, "openTypeNamePreferredFamilyName")
+    styleName = getAttrWithFallback(info, "openTypeNamePreferredSubfamilyName")
+    return familyName, styleName
+
+
 def postscriptFontNameFallback(info):
     """
     Fallback to a string containing only valid characters
     as defined in the specification. This will draw from
     *openTypeNamePreferredFamilyName* and *openTypeNamePreferredSubfamilyName*.
     """
-    name = u"%s-%s" % (getAttrWithFallback(info, "openTypeNamePreferredFamilyName"), getAttrWithFallback(info, "openTypeNamePreferredSubfamilyName"))
-    return normalizeNameForPostscript(name)
+    familyName, styleName = _preferredFamilyAndSubfamilyNames(info)
+    return normalizeNameForPostscript(f"{familyName}-{styleName}")
 
 
 def postscriptFullNameFallback(info):
     """
     Fallback to *openTypeNamePreferredFamilyName openTypeNamePreferredSubfamilyName*.
     """
-    name = u"%s %s" % (getAttrWithFallback(info, "openTypeNamePreferredFamilyName"), getAttrWithFallback(info, "openTypeNamePreferredSubfamilyName"))
-    return normalizeNameForPostscript(name)
+    familyName, styleName = _preferredFamilyAndSubfamilyNames(info)
+    return normalizeNameForPostscript(f"{familyName} {styleName}")
 
 
 def postscriptSlantAngleFallback(info):
@@ -250,17 +289,18 @@ def postscriptUnderlinePositionFallback(info):
     return getAttrWithFallback(info, "unitsPerEm") * -0.075
 
 
-_postscriptWeightNameOptions = {
-    100: "Thin",
-    200: "Extra-light",
-    300: "Light",
-    400: "Normal",
-    500: "Medium",
-    600: "Semi-bold",
-    700: "Bold",
-    800: "Extra-bold",
-    900: "Black"
-}
+# indexed by (weight class // 100) - 1
+_postscriptWeightNameOptions = (
+    "Thin",         # 100
+    "Extra-light",  # 200
+    "Light",        # 300
+    "Normal",       # 400
+    "Medium",       # 500
+    "Semi-bold",    # 600
+    "Bold",         # 700
+    "Extra-bold",   # 800
+    "Black"         # 900
+)
 
 
 def postscriptWeightNameFallback(info):
@@ -281,13 +321,12 @@ def postscriptWeightNameFallback(info):
     ===  ===========
     """
     value = getAttrWithFallback(info, "openTypeOS2WeightClass")
-    value = int(round(value * .01) * 100)
-    if value < 100:
-        value = 100
-    elif value > 900:
-        value = 900
-    name = _postscriptWeightNameOptions[value]
-    return name
+    value = int(round(value * .01))
+    if value < 1:
+        value = 1
+    elif value > 9:
+        value = 9
+    return _postscriptWeightNameOptions[value - 1]
 
 
 def postscriptBlueScaleFallback(info):
@@ -298,27 +337,47 @@ def postscriptBlueScaleFallback(info):
     """
     blues = getAttrWithFallback(info, "postscriptBlueValues")
     otherBlues = getAttrWithFallback(info, "postscriptOtherBlues")
-    maxZoneHeight = 0
+    assert len(blues) % 2 == 0
+    assert len(otherBlues) % 2 == 0
+    zones = list(blues) + list(otherBlues)
     blueScale = 0.039625
-    if blues:
-        assert len(blues) % 2 == 0
-        for x, y in zip(blues[:-1:2], blues[1::2]):
-            maxZoneHeight = max(maxZoneHeight, abs(y - x))
-    if otherBlues:
-        assert len(otherBlues) % 2 == 0
-        for x, y in zip(otherBlues[:-1:2], otherBlues[1::2]):
-            maxZoneHeight = max(maxZoneHeight, abs(y - x))
-    if maxZoneHeight != 0:
-        blueScale = 3 / (4 * maxZoneHeight)
+    if zones:
+        maxZoneHeight = max(abs(y - x) for x, y in zip(zones[::2], zones[1::2]))
+        if maxZoneHeight != 0:
+            blueScale = 3 / (4 * maxZoneHeight)
     return blueScale
 
 
+_optimizedWidthsCache = weakref.WeakKeyDictionary()
+
+
 def _postscriptDefaultAndNominalWidthXFallback(info):
     font = info.font
-    # calculate for the current default layer
-    if font:
-        return optimizeWidths([int(round(glyph.width)) for glyph in font])
-    return None, None
+    if not font:
+        return None, None
+    # the default and nominal fallbacks both need this
+    # result and resolve as two separate top level
+    # lookups, so the result is cached per font. the
+    # widths it was calculated from are stored with it
+    # and compared on every hit, so a font edited after
+    # a compile is never served stale values: gathering
+    # the widths again is cheap, rerunning the
+    # optimization is not.
+    # gather for the current default layer
+    widths = [int(round(glyph.width)) for glyph in font]
+    try:
+        cached = _optimizedWidthsCache.get(font)
+    except TypeError:
+        # the font object doesn't support weak references
+        cached = None
+    if cached is not None and cached[0] == widths:
+        return cached[1]
+    result = optimizeWidths(widths)
+    try:
+        _optimizedWidthsCache[font] = (widths, result)
+    except TypeError:
+        pass
+    return result
 
 
 def postscriptDefaultWidthXFallback(info):
@@ -366,7 +425,10 @@ def woffMetadataUniqueIDFallback(info):
 # Attribute Maps
 # --------------
 
-staticFallbackData = dict(
+# this table never changes at runtime, so freeze it.
+# the keys are keyword arguments and therefore interned,
+# which keeps the lookups on the dict fast path.
+staticFallbackData = types.MappingProxyType(dict(
     styleMapStyleName="regular",
     versionMajor=0,
     versionMinor=0,
@@ -458,7 +520,7 @@ staticFallbackData = dict(
     # not used in OTF
     macintoshFONDFamilyID=None,
     macintoshFONDName=None
-)
+))
 
 specialFallbacks = dict(
     styleMapFamilyName=styleMapFamilyNameFallback,
@@ -489,9 +551,26 @@ specialFallbacks = dict(
     postscriptUnderlinePosition=postscriptUnderlinePositionFallback,
 )
 
-requiredAttributes = set(ufoLib.fontInfoAttributesVersion2) - (set(staticFallbackData.keys()) | set(specialFallbacks.keys()))
 
-recommendedAttributes = set([
+def _makeStaticResolver(value):
+    def resolver(info):
+        return value
+    return resolver
+
+
+# one merged dispatch table: every attribute maps to a
+# callable taking the info object, so getAttrWithFallback
+# resolves a fallback with a single lookup and call.
+_fallbackResolvers = {}
+for _attr, _value in staticFallbackData.items():
+    _fallbackResolvers[_attr] = _makeStaticResolver(_value)
+del _attr, _value
+# the special fallbacks win if an attribute is in both
+_fallbackResolvers.update(specialFallbacks)
+
+requiredAttributes = frozenset(ufoLib.fontInfoAttributesVersion2) - (set(staticFallbackData.keys()) | set(specialFallbacks.keys()))
+
+recommendedAttributes = frozenset([
     "styleMapFamilyName",
     "versionMajor",
     "versionMinor",
@@ -523,11 +602,41 @@ recommendedAttributes = set([
     "postscriptStemSnapV"
 ])
 
+# attrgetter pulls all of the values in one call,
+# which is noticeably cheaper than a getattr per
+# attribute when preflighting ~60 attributes.
+_requiredAttributeNames = tuple(sorted(requiredAttributes))
+_requiredAttributeGetter = operator.attrgetter(*_requiredAttributeNames)
+_recommendedAttributeNames = tuple(sorted(recommendedAttributes))
+_recommendedAttributeGetter = operator.attrgetter(*_recommendedAttributeNames)
+
+
+def _findMissingAttributes(info, names, getter):
+    try:
+        values = getter(info)
+    except AttributeError:
+        # the info object doesn't define every attribute,
+        # so fall back to testing them one by one
+        return set(attr for attr in names if getattr(info, attr, None) is None)
+    return set(attr for attr, value in zip(names, values) if value is None)
+
 
 # ------------
 # Main Methods
 # ------------
 
+# The special fallbacks call getAttrWithFallback recursively
+# (for example, resolving postscriptFontName resolves the
+# preferred family and subfamily names, each of which may
+# resolve further attributes). The cache below collapses the
+# duplicate lookups within one outer resolution. It is cleared
+# when the outer call completes so that later changes to the
+# info object are always picked up.
+
+_fallbackCache = weakref.WeakKeyDictionary()
+_fallbackDepth = 0
+
+
 def getAttrWithFallback(info, attr):
     """
     Get the value for *attr* from the *info* object.
@@ -536,13 +645,25 @@ def getAttrWithFallback(info, attr):
     value from a predefined set of attributes or it
     will synthesize a value from the available data.
     """
-    if hasattr(info, attr) and getattr(info, attr) is not None:
-        value = getattr(info, attr)
-    else:
-        if attr in specialFallbacks:
-            value = specialFallbacks[attr](info)
-        else:
-            value = staticFallbackData[attr]
+    global _fallbackDepth
+    value = getattr(info, attr, None)
+    if value is not None:
+        return value
+    try:
+        cache = _fallbackCache.setdefault(info, {})
+    except TypeError:
+        # the info object doesn't support weak references
+        cache = {}
+    if attr in cache:
+        return cache[attr]
+    _fallbackDepth += 1
+    try:
+        value = _fallbackResolvers[attr](info)
+        cache[attr] = value
+    finally:
+        _fallbackDepth -= 1
+        if not _fallbackDepth:
+            cache.clear()
     return value
 
 
@@ -556,40 +677,64 @@ def preflightInfo(info):
     missingRecommended  Recommended data that is missing.
     ==================  ===
     """
-    missingRequired = set()
-    missingRecommended = set()
-    for attr in requiredAttributes:
-        if not hasattr(info, attr) or getattr(info, attr) is None:
-            missingRequired.add(attr)
-    for attr in recommendedAttributes:
-        if not hasattr(info, attr) or getattr(info, attr) is None:
-            missingRecommended.add(attr)
+    missingRequired = _findMissingAttributes(info, _requiredAttributeNames, _requiredAttributeGetter)
+    missingRecommended = _findMissingAttributes(info, _recommendedAttributeNames, _recommendedAttributeGetter)
     return dict(missingRequired=missingRequired, missingRecommended=missingRecommended)
 
 
+_fontBoundsCache = weakref.WeakKeyDictionary()
+
+
 def getFontBounds(font):
     """
     Get a tuple of (xMin, yMin, xMax, yMax) for all
-    glyphs in the given *font*.
+    glyphs in the given *font*. defcon fonts maintain
+    their own bounds and invalidate them when glyphs
+    change, so those are returned directly. For other
+    font objects the result of walking every outline is
+    cached per font; if glyphs are changed after the
+    first call, use :func:`invalidateFontBounds` to
+    force a recalculation.
     """
-    rect = None
     # defcon
     if hasattr(font, "bounds"):
         rect = font.bounds
+        if rect is None:
+            rect = (0, 0, 0, 0)
+        return rect
     # others
-    else:
-        for glyph in font:
-            bounds = glyph.bounds
-            if rect is None:
-                rect = bounds
-                continue
-            if rect is not None and bounds is not None:
-                rect = unionRect(rect, bounds)
+    try:
+        return _fontBoundsCache[font]
+    except (KeyError, TypeError):
+        pass
+    rect = None
+    for glyph in font:
+        bounds = glyph.bounds
+        if rect is None:
+            rect = bounds
+            continue
+        if rect is not None and bounds is not None:
+            rect = unionRect(rect, bounds)
     if rect is None:
         rect = (0, 0, 0, 0)
+    try:
+        _fontBoundsCache[font] = rect
+    except TypeError:
+        # the font object doesn't support weak references
+        pass
     return rect
 
 
+def invalidateFontBounds(font):
+    """
+    Remove the cached bounds for *font*. This must be
+    called if the glyphs of a non-defcon font are
+    changed after the bounds have been calculated with
+    :func:`getFontBounds`.
+    """
+    _fontBoundsCache.pop(font, None)
+
+
 # -----------------
 # Low Level Support
 # -----------------
@@ -597,28 +742,33 @@ def getFontBounds(font):
 # these should not be used outside of this package
 
 def intListToNum(intList, start, length):
-    all = []
-    bin = ""
-    for i in range(start, start + length):
-        if i in intList:
-            b = "1"
-        else:
-            b = "0"
-        bin = b + bin
-        if not (i + 1) % 8:
-            all.append(bin)
-            bin = ""
-    if bin:
-        all.append(bin)
-    all.reverse()
-    all = " ".join(all)
-    return binary2num(all)
+    num = 0
+    end = start + length
+    for i in intList:
+        if start <= i < end:
+            num |= 1 << (i - start)
+    return num
 
 
 def dateStringToTimeValue(date):
+    # slice the fixed "%Y/%m/%d %H:%M:%S" layout directly.
+    # this is much cheaper than strptime, which is kept
+    # only as a safety net for unusual input.
+    if len(date) == 19 and date[4] == "/" and date[7] == "/" and date[10] == " " and date[13] == ":" and date[16] == ":":
+        try:
+            # the datetime constructor validates the ranges
+            t = datetime.datetime(
+                int(date[0:4]), int(date[5:7]), int(date[8:10]),
+                int(date[11:13]), int(date[14:16]), int(date[17:19])
+            )
+            return int(_timegm(t.timetuple()))
+        except ValueError:
+            # out-of-range fields (such as leap seconds)
+            # get another chance with strptime below
+            pass
     try:
         t = time.strptime(date, "%Y/%m/%d %H:%M:%S")
-        return int(calendar.timegm(t))
+        return int(_timegm(t))
     except ValueError:
         return 0
 
@@ -629,6 +779,15 @@ def dateStringToTimeValue(date):
 
 class _TestInfoObject(object):
 
+    __slots__ = (
+        "__weakref__",
+        "familyName", "styleName",
+        "unitsPerEm", "descender", "xHeight", "capHeight", "ascender",
+        "bounds",
+        # set by the tests
+        "styleMapFamilyName", "versionMajor", "versionMinor"
+    )
+
     def __init__(self):
         self.familyName = "Family Name"
         self.styleName = "Style Name"
@@ -639,6 +798,10 @@ class _TestInfoObject(object):
         self.ascender = 650
         self.bounds = (0, -225, 100, 755)
 
+    @property
+    def font(self):
+        return self
+
     def getParent(self):
         return self
 
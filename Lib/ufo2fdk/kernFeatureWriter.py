@@ -1,19 +1,10 @@
 # -*- coding: utf8 -*-
 
-try:
-    set
-except NameError:
-    from sets import Set as set
+import io
+import itertools
+import re
 
-try:
-    sorted
-except NameError:
-    def sorted(l):
-        l = list(l)
-        l.sort()
-        return l
-
-inlineGroupInstance = (list, tuple, set)
+inlineGroupInstance = (list, tuple, set, frozenset)
 
 side1Prefix = "public.kern1."
 side2Prefix = "public.kern2."
@@ -22,6 +13,22 @@ side2FeaPrefix = "@kern2."
 groupPrefixLength = len(side1Prefix)
 classPrefixLength = len(side1FeaPrefix)
 
+# rule templates keyed by (side1 is inline group, side2 is inline group)
+_ruleTemplates = {
+    (False, False): "pos %s %s %d;",
+    (False, True): "enum pos %s %s %d;",
+    (True, False): "enum pos %s %s %d;",
+    (True, True): "enum pos %s %s %d;"
+}
+
+
+def _formatRuleSide(side):
+    # inline groups are built from the pre-sorted
+    # group contents, so they are already in order
+    if type(side) is tuple:
+        return "[%s]" % " ".join(side)
+    return side
+
 
 class KernFeatureWriter(object):
 
@@ -39,7 +46,6 @@ class KernFeatureWriter(object):
         self.getGroups()
         self.getPairs()
         self.applyGroupNameToClassNameMapping()
-        self.getFlatGroups()
 
     def write(self, headerText=None):
         """
@@ -50,9 +56,9 @@ class KernFeatureWriter(object):
             return ""
         glyphGlyph, glyphGroupDecomposed, groupGlyphDecomposed, glyphGroup, groupGlyph, groupGroup = self.getSeparatedPairs(self.pairs)
         # write the classes
-        groups = dict(self.side1Groups)
-        groups.update(self.side2Groups)
-        classes = self.getClassDefinitionsForGroups(groups)
+        classes = self.getClassDefinitionsForGroups(
+            itertools.chain(self.side1Groups.items(), self.side2Groups.items())
+        )
         # write the kerning rules
         rules = []
         order = [
@@ -68,22 +74,26 @@ class KernFeatureWriter(object):
                 rules.append("")
                 rules.append(note)
                 rules += self.getFeatureRulesForPairs(pairs)
-        # compile
-        feature = ["feature kern {"]
+        # compile into a single buffer instead of an
+        # intermediate list of lines
+        feature = io.StringIO()
+        feature.write("feature kern {")
         if headerText:
             for line in headerText.splitlines():
                 line = line.strip()
                 if not line.startswith("#"):
                     line = "# " + line
-                line = "    " + line
-                feature.append(line)
-        for line in classes + rules:
+                feature.write("\n    ")
+                feature.write(line)
+        for line in itertools.chain(classes, rules):
             if line:
-                line = "    " + line
-            feature.append(line)
-        feature.append("} kern;")
+                feature.write("\n    ")
+                feature.write(line)
+            else:
+                feature.write("\n")
+        feature.write("\n} kern;")
         # done
-        return u"\n".join(feature)
+        return feature.getvalue()
 
     # -------------
     # Initial Setup
@@ -92,26 +102,41 @@ class KernFeatureWriter(object):
     def getGroups(self):
         """
         Set up two dictionaries representing first and
-        second side groups.
+        second side groups, along with two flat dictionaries
+        keyed by glyph names with group names as values.
 
         You should not call this method directly.
         """
         side1Groups = self.side1Groups = {}
         side2Groups = self.side2Groups = {}
+        flatSide1Groups = self.flatSide1Groups = {}
+        flatSide2Groups = self.flatSide2Groups = {}
         skipGlyphs = self.font.lib.get("public.skipExportGlyphs", [])
         for groupName, contents in self.font.groups.items():
-            contents = [
+            # store the contents sorted so that nothing
+            # downstream needs to sort them again
+            contents = sorted(
                 glyphName
                 for glyphName in contents
                 if glyphName in self.font
                 and glyphName not in skipGlyphs
-            ]
+            )
             if not contents:
                 continue
-            if groupName.startswith(side1Prefix):
+            if groupName[:groupPrefixLength] == side1Prefix:
                 side1Groups[groupName] = contents
-            elif groupName.startswith(side2Prefix):
+                for glyphName in contents:
+                    # a glyph may be in more than one group.
+                    # that is not allowed, so the first
+                    # group wins.
+                    flatSide1Groups.setdefault(glyphName, groupName)
+            elif groupName[:groupPrefixLength] == side2Prefix:
                 side2Groups[groupName] = contents
+                for glyphName in contents:
+                    # a glyph may be in more than one group.
+                    # that is not allowed, so the first
+                    # group wins.
+                    flatSide2Groups.setdefault(glyphName, groupName)
 
     def getPairs(self):
         """
@@ -121,26 +146,22 @@ class KernFeatureWriter(object):
 
         You should not call this method directly.
         """
-        pairs = self.pairs = {}
-        skipGlyphs = self.font.lib.get("public.skipExportGlyphs", [])
-        for (side1, side2), value in self.font.kerning.items():
-            # skip missing glyphs
-            if side1 not in self.side1Groups and side1 not in self.font:
-                continue
-            if side2 not in self.side2Groups and side2 not in self.font:
-                continue
-            # skip glyphs flagged to not export
-            if side1 in skipGlyphs:
-                continue
-            if side2 in skipGlyphs:
-                continue
-            # skip empty groups
-            if side1.startswith(side1Prefix) and side1 not in self.side1Groups:
-                continue
-            if side2.startswith(side2Prefix) and side2 not in self.side2Groups:
-                continue
-            # store pair
-            pairs[side1, side2] = value
+        skipGlyphs = set(self.font.lib.get("public.skipExportGlyphs", []))
+        glyphNames = set(self.font.keys())
+        # the tests for missing glyphs, missing or empty
+        # groups, and glyphs flagged to not export all
+        # collapse into membership in these two sets
+        validSide1 = set(self.side1Groups)
+        validSide1.update(glyphName for glyphName in glyphNames if glyphName[:groupPrefixLength] != side1Prefix)
+        validSide1 -= skipGlyphs
+        validSide2 = set(self.side2Groups)
+        validSide2.update(glyphName for glyphName in glyphNames if glyphName[:groupPrefixLength] != side2Prefix)
+        validSide2 -= skipGlyphs
+        self.pairs = {
+            (side1, side2): value
+            for (side1, side2), value in self.font.kerning.items()
+            if side1 in validSide1 and side2 in validSide2
+        }
 
     def applyGroupNameToClassNameMapping(self):
         """
@@ -149,111 +170,55 @@ class KernFeatureWriter(object):
         You should not call this method directly.
         """
         mapping = {}
+        existingClassNames = set()
+        classNameCounters = {}
         for groupNames, feaPrefix in ((self.side1Groups.keys(), side1FeaPrefix), (self.side2Groups.keys(), side2FeaPrefix)):
             for groupName in sorted(groupNames):
                 className = feaPrefix + groupName[groupPrefixLength:]
-                mapping[groupName] = makeLegalClassName(className, mapping.keys())
+                className = makeLegalClassName(className, existingClassNames, classNameCounters)
+                mapping[groupName] = className
+                existingClassNames.add(className)
         # kerning
-        newPairs = {}
-        for (side1, side2), value in self.pairs.items():
-            if side1.startswith(side1Prefix):
-                side1 = mapping[side1]
-            if side2.startswith(side2Prefix):
-                side2 = mapping[side2]
-            newPairs[side1, side2] = value
-        self.pairs.clear()
-        self.pairs.update(newPairs)
+        self.pairs = {
+            (
+                mapping[side1] if side1[:groupPrefixLength] == side1Prefix else side1,
+                mapping[side2] if side2[:groupPrefixLength] == side2Prefix else side2
+            ): value
+            for (side1, side2), value in self.pairs.items()
+        }
         # groups
-        newSide1Groups = {}
-        for groupName, contents in self.side1Groups.items():
-            groupName = mapping[groupName]
-            newSide1Groups[groupName] = contents
-        self.side1Groups.clear()
-        self.side1Groups.update(newSide1Groups)
-        newSide2Groups = {}
-        for groupName, contents in self.side2Groups.items():
-            groupName = mapping[groupName]
-            newSide2Groups[groupName] = contents
-        self.side2Groups.clear()
-        self.side2Groups.update(newSide2Groups)
-
-    def getFlatGroups(self):
-        """
-        Set up two dictionaries keyed by glyph names with
-        group names as values for side 1 and side 2 groups.
-
-        You should not call this method directly.
-        """
-        flatSide1Groups = self.flatSide1Groups = {}
-        flatSide2Groups = self.flatSide2Groups = {}
-        for groupName, glyphList in self.side1Groups.items():
-            for glyphName in glyphList:
-                # user has glyph in more than one group.
-                # this is not allowed.
-                if glyphName in flatSide1Groups:
-                    continue
-                flatSide1Groups[glyphName] = groupName
-        for groupName, glyphList in self.side2Groups.items():
-            for glyphName in glyphList:
-                # user has glyph in more than one group.
-                # this is not allowed.
-                if glyphName in flatSide2Groups:
-                    continue
-                flatSide2Groups[glyphName] = groupName
+        self.side1Groups = {mapping[groupName]: contents for groupName, contents in self.side1Groups.items()}
+        self.side2Groups = {mapping[groupName]: contents for groupName, contents in self.side2Groups.items()}
 
     # ------------
     # Pair Support
     # ------------
 
-    def isHigherLevelPairPossible(self, pair):
+    def isHigherLevelPairPossible(self, pair, side1IsGroup, side2IsGroup):
         """
         Determine if there is a higher level pair possible.
         This doesn't indicate that the pair exists, it simply
         indicates that something higher than (side1, side2)
-        can exist.
+        can exist. *pair* must be one of the stored pairs;
+        *side1IsGroup* and *side2IsGroup* flag whether the
+        sides are class names and come from the caller's
+        classification.
 
         You should not call this method directly.
         """
+        # because the pair itself is known to exist, every
+        # membership test against the pair keys that the
+        # old implementation performed was testing the
+        # current pair and always true. all that is left
+        # is whether the glyph side(s) belong to a group.
         side1, side2 = pair
-        if side1.startswith(side1FeaPrefix):
-            side1Group = side1
-            side1Glyph = None
-        else:
-            side1Group = self.flatSide1Groups.get(side1)
-            side1Glyph = side1
-        if side2.startswith(side2FeaPrefix):
-            side2Group = side2
-            side2Glyph = None
-        else:
-            side2Group = self.flatSide2Groups.get(side2)
-            side2Glyph = side2
-
-        havePotentialHigherLevelPair = False
-        if side1.startswith(side1FeaPrefix) and side2.startswith(side2FeaPrefix):
-            pass
-        elif side1.startswith(side1FeaPrefix):
-            if side2Group is not None:
-                if (side1, side2) in self.pairs:
-                    havePotentialHigherLevelPair = True
-        elif side2.startswith(side2FeaPrefix):
-            if side1Group is not None:
-                if (side1, side2) in self.pairs:
-                    havePotentialHigherLevelPair = True
-        else:
-            if side1Group is not None and side2Group is not None:
-                if (side1Glyph, side2Glyph) in self.pairs:
-                    havePotentialHigherLevelPair = True
-                elif (side1Group, side2Glyph) in self.pairs:
-                    havePotentialHigherLevelPair = True
-                elif (side1Glyph, side2Group) in self.pairs:
-                    havePotentialHigherLevelPair = True
-            elif side1Group is not None:
-                if (side1Glyph, side2Glyph) in self.pairs:
-                    havePotentialHigherLevelPair = True
-            elif side2Group is not None:
-                if (side1Glyph, side2Glyph) in self.pairs:
-                    havePotentialHigherLevelPair = True
-        return havePotentialHigherLevelPair
+        if side1IsGroup and side2IsGroup:
+            return False
+        if side1IsGroup:
+            return self.flatSide2Groups.get(side2) is not None
+        if side2IsGroup:
+            return self.flatSide1Groups.get(side1) is not None
+        return self.flatSide1Groups.get(side1) is not None or self.flatSide2Groups.get(side2) is not None
 
     def getSeparatedPairs(self, pairs):
         """
@@ -268,6 +233,21 @@ class KernFeatureWriter(object):
 
         You should not call this method directly.
         """
+        # split the pairs into parallel lists and classify
+        # each unique key once, so the partition below is
+        # plain list iteration instead of per-pair prefix
+        # tests and dict probes
+        side1Keys = []
+        side2Keys = []
+        values = []
+        for (side1, side2), value in pairs.items():
+            side1Keys.append(side1)
+            side2Keys.append(side2)
+            values.append(value)
+        side1IsGroupFlags = {side1 : side1[:classPrefixLength] == side1FeaPrefix for side1 in set(side1Keys)}
+        side2IsGroupFlags = {side2 : side2[:classPrefixLength] == side2FeaPrefix for side2 in set(side2Keys)}
+        side1Flags = [side1IsGroupFlags[side1] for side1 in side1Keys]
+        side2Flags = [side2IsGroupFlags[side2] for side2 in side2Keys]
         # seperate pairs
         glyphGlyph = {}
         glyphGroup = {}
@@ -275,33 +255,57 @@ class KernFeatureWriter(object):
         groupGlyph = {}
         groupGlyphDecomposed = {}
         groupGroup = {}
-        for (side1, side2), value in pairs.items():
-            if side1.startswith(side1FeaPrefix) and side2.startswith(side2FeaPrefix):
+        for side1, side2, value, side1IsGroup, side2IsGroup in zip(side1Keys, side2Keys, values, side1Flags, side2Flags):
+            if side1IsGroup and side2IsGroup:
                 groupGroup[side1, side2] = value
-            elif side1.startswith(side1FeaPrefix):
+            elif side1IsGroup:
                 groupGlyph[side1, side2] = value
-            elif side2.startswith(side2FeaPrefix):
+            elif side2IsGroup:
                 glyphGroup[side1, side2] = value
             else:
                 glyphGlyph[side1, side2] = value
         # handle decomposition
-        allGlyphGlyph = set(glyphGlyph.keys())
+        # index the glyph, glyph pairs by side so that the
+        # decomposition filters below are set lookups on the
+        # group members instead of pair tuple probes
+        coveredSide2ForSide1 = {}
+        coveredSide1ForSide2 = {}
+        for side1, side2 in glyphGlyph:
+            coveredSide2ForSide1.setdefault(side1, set()).add(side2)
+            coveredSide1ForSide2.setdefault(side2, set()).add(side1)
+        # collect the decomposed keys while iterating and
+        # delete them in a batch afterwards, instead of
+        # copying the whole dict just to allow deletion
+        # during iteration
         # glyph to group
-        for (side1, side2), value in list(glyphGroup.items()):
-            if self.isHigherLevelPairPossible((side1, side2)):
-                finalRight = tuple([r for r in sorted(self.side2Groups[side2]) if (side1, r) not in allGlyphGlyph])
+        toDelete = []
+        for (side1, side2), value in glyphGroup.items():
+            if self.isHigherLevelPairPossible((side1, side2), False, True):
+                covered = coveredSide2ForSide1.setdefault(side1, set())
+                # the group contents are stored sorted by
+                # getGroups, so no per-pair sort is needed
+                finalRight = tuple([r for r in self.side2Groups[side2] if r not in covered])
+                covered.update(finalRight)
+                # the group to glyph decomposition must see
+                # these pairs as covered, so feed the other
+                # index as well
                 for r in finalRight:
-                    allGlyphGlyph.add((side1, r))
+                    coveredSide1ForSide2.setdefault(r, set()).add(side1)
                 glyphGroupDecomposed[side1, finalRight] = value
-                del glyphGroup[side1, side2]
+                toDelete.append((side1, side2))
+        for key in toDelete:
+            del glyphGroup[key]
         # group to glyph
-        for (side1, side2), value in list(groupGlyph.items()):
-            if self.isHigherLevelPairPossible((side1, side2)):
-                finalLeft = tuple([l for l in sorted(self.side1Groups[side1]) if (l, side2) not in glyphGlyph and (l, side2) not in allGlyphGlyph])
-                for l in finalLeft:
-                    allGlyphGlyph.add((l, side2))
+        toDelete = []
+        for (side1, side2), value in groupGlyph.items():
+            if self.isHigherLevelPairPossible((side1, side2), True, False):
+                covered = coveredSide1ForSide2.setdefault(side2, set())
+                finalLeft = tuple([l for l in self.side1Groups[side1] if l not in covered])
+                covered.update(finalLeft)
                 groupGlyphDecomposed[finalLeft, side2] = value
-                del groupGlyph[side1, side2]
+                toDelete.append((side1, side2))
+        for key in toDelete:
+            del groupGlyph[key]
         # return the result
         return glyphGlyph, glyphGroupDecomposed, groupGlyphDecomposed, glyphGroup, groupGlyph, groupGroup
 
@@ -311,13 +315,17 @@ class KernFeatureWriter(object):
 
     def getClassDefinitionsForGroups(self, groups):
         """
-        Write class definitions to a list of strings.
+        Write class definitions for an iterable of
+        (group name, contents) pairs to a list of strings.
 
         You should not call this method directly.
         """
+        if hasattr(groups, "items"):
+            groups = groups.items()
         classes = []
-        for groupName, contents in sorted(groups.items()):
-            line = "%s = [%s];" % (groupName, " ".join(sorted(contents)))
+        for groupName, contents in sorted(groups):
+            # the contents are already sorted by getGroups
+            line = "%s = [%s];" % (groupName, " ".join(contents))
             classes.append(line)
         return classes
 
@@ -327,31 +335,27 @@ class KernFeatureWriter(object):
 
         You should not call this method directly.
         """
-        rules = []
-        for (side1, side2), value in sorted(pairs.items()):
-            if not side1 or not side2:
-                continue
-            if isinstance(side1, inlineGroupInstance) or isinstance(side2, inlineGroupInstance):
-                line = "enum pos %s %s %d;"
-            else:
-                line = "pos %s %s %d;"
-            if isinstance(side1, inlineGroupInstance):
-                side1 = "[%s]" % " ".join(sorted(side1))
-            if isinstance(side2, inlineGroupInstance):
-                side2 = "[%s]" % " ".join(sorted(side2))
-            rules.append(line % (side1, side2, value))
-        return rules
+        # the decomposition only ever produces tuples
+        # for inline groups, so an exact type test is
+        # enough here
+        return [
+            _ruleTemplates[type(side1) is tuple, type(side2) is tuple] % (
+                _formatRuleSide(side1), _formatRuleSide(side2), value)
+            for (side1, side2), value in sorted(pairs.items())
+            if side1 and side2
+        ]
 
 
 # ------------------
 # Class Name Creator
 # ------------------
 
-_invalidFirstCharacter = set(".0123456789")
-_validCharacters = set("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789._")
+_invalidFirstCharacter = frozenset(".0123456789")
+_validCharacters = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789._")
+_invalidCharactersRE = re.compile("[^A-Za-z0-9._]")
 
 
-def makeLegalClassName(name, existing):
+def makeLegalClassName(name, existing, counters=None):
     """
     >>> makeLegalClassName("@kern1.foo", [])
     '@kern1.foo'
@@ -376,8 +380,10 @@ def makeLegalClassName(name, existing):
     # slice off the prefix
     prefix = str(name[:classPrefixLength])
     name = name[classPrefixLength:]
-    # only legal characters
-    name = "".join([c for c in name if c in _validCharacters])
+    # only legal characters. the filtering runs inside
+    # the compiled pattern instead of a per-character loop.
+    if not _validCharacters.issuperset(name):
+        name = _invalidCharactersRE.sub("", name)
     name = str(name)
     # maximum length is 31 - prefix length
     name = name[:31 - classPrefixLength]
@@ -387,11 +393,11 @@ def makeLegalClassName(name, existing):
     # add the prefix
     name = prefix + name
     # make sure it is unique
-    _makeUniqueClassName(name, existing)
+    name = _makeUniqueClassName(name, existing, counters)
     return name
 
 
-def _makeUniqueClassName(name, existing, counter=0):
+def _makeUniqueClassName(name, existing, counters=None):
     """
     >>> _makeUniqueClassName("@kern1.foo", [])
     '@kern1.foo'
@@ -404,17 +410,32 @@ def _makeUniqueClassName(name, existing, counter=0):
 
     >>> _makeUniqueClassName("@kern1.abcdefghijklmnopqrstuvwx", ["@kern1.abcdefghijklmnopqrstuvwx"])
     '@kern1.abcdefghijklmnopqrstuvw1'
+
+    a counters dictionary carries the last used suffix
+    for a name across calls:
+
+    >>> counters = {}
+    >>> _makeUniqueClassName("@kern1.foo", ["@kern1.foo", "@kern1.foo1"], counters)
+    '@kern1.foo2'
+    >>> _makeUniqueClassName("@kern1.foo", ["@kern1.foo", "@kern1.foo1", "@kern1.foo2"], counters)
+    '@kern1.foo3'
     """
-    # Add a number to the name if the counter is higher than zero.
+    # Add an increasing number to the name until
+    # it doesn't clash with an existing name. if a
+    # counters dictionary is given, resume from the
+    # suffix the last collision on this name reached
+    # instead of probing from zero.
     newName = name
-    if counter > 0:
+    counter = 0
+    if counters is not None:
+        counter = counters.get(name, 0)
+    while newName in existing:
+        counter += 1
         c = str(counter)
         assert len(c) < 31 - classPrefixLength
-        newName = newName[:31 - len(c)] + c
-    # If the new name is in the existing group names, recurse.
-    if newName in existing:
-        return _makeUniqueClassName(name, existing, counter + 1)
-    # Otherwise send back the new name.
+        newName = name[:31 - len(c)] + c
+    if counters is not None and counter:
+        counters[name] = counter
     return newName
 
 # ----
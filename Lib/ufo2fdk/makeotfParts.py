@@ -1,8 +1,10 @@
 from __future__ import absolute_import
 import codecs
+import functools
 import os
 import shutil
 import re
+import sys
 from ufo2fdk.fontInfoData import getAttrWithFallback, intListToNum, normalizeStringForPostscript
 from ufo2fdk.outlineOTF import OutlineOTFCompiler
 from ufo2fdk.featureTableWriter import FeatureTableWriter, winStr, macStr
@@ -14,6 +16,77 @@ def toBytes(s, encoding="utf-8"):
     return s.encode(encoding)
 
 
+class _InfoProxy(object):
+
+    """
+    A tiny memoizing wrapper around getAttrWithFallback.
+    Attribute access on this object resolves the attribute
+    through the fallback system once and caches the result.
+    """
+
+    def __init__(self, info):
+        self._info = info
+        self._cache = {}
+
+    def __getattr__(self, attr):
+        cache = self._cache
+        if attr not in cache:
+            cache[attr] = getAttrWithFallback(self._info, attr)
+        return cache[attr]
+
+
+# OS/2 code page bit -> FDK code page number,
+# indexable by bit for the full 64 bit range
+_codePageBitTranslation = {
+    0  : "1252",
+    1  : "1250",
+    2  : "1251",
+    3  : "1253",
+    4  : "1254",
+    5  : "1255",
+    6  : "1256",
+    7  : "1257",
+    8  : "1258",
+    16 : "874",
+    17 : "932",
+    18 : "936",
+    19 : "949",
+    20 : "950",
+    21 : "1361",
+    48 : "869",
+    49 : "866",
+    50 : "865",
+    51 : "864",
+    52 : "863",
+    53 : "862",
+    54 : "861",
+    55 : "860",
+    56 : "857",
+    57 : "855",
+    58 : "852",
+    59 : "775",
+    60 : "737",
+    61 : "708",
+    62 : "850",
+    63 : "437"
+}
+_codePageBitTranslation = tuple(_codePageBitTranslation.get(i) for i in range(64))
+
+# name table id -> info attribute
+_nameIDToAttr = (
+    (0  , "copyright"),
+    (7  , "trademark"),
+    (8  , "openTypeNameManufacturer"),
+    (9  , "openTypeNameDesigner"),
+    (10 , "openTypeNameDescription"),
+    (11 , "openTypeNameManufacturerURL"),
+    (12 , "openTypeNameDesignerURL"),
+    (13 , "openTypeNameLicense"),
+    (14 , "openTypeNameLicenseURL"),
+    (19 , "openTypeNameSampleText")
+)
+
+
 class MakeOTFPartsCompiler(object):
 
     """
@@ -37,6 +110,7 @@ class MakeOTFPartsCompiler(object):
         self.font = font
         self.path = path
         self.log = []
+        self._info = _InfoProxy(font.info)
         self.outlineCompilerClass = outlineCompilerClass
         # store the path to an eventual custom feature file
         self.features = features
@@ -63,20 +137,34 @@ class MakeOTFPartsCompiler(object):
         finalMap = {}
         if providedMap is not None:
             finalMap.update(providedMap)
-        # gather glyphs that need a final name
-        needFinalName = [glyphName for glyphName in self.glyphOrder if glyphName not in finalMap]
-        # store names that don't need to be changed
-        for glyphName in needFinalName:
+        # store names that don't need to be changed,
+        # gathering the glyphs that still need a final
+        # name along the way. all legal names must be
+        # reserved before any new names are generated
+        # so that a generated name can't steal the name
+        # of a legal glyph later in the order. the
+        # normalization helpers repeatedly test
+        # membership in the taken names, so track those
+        # in a set.
+        taken = set(finalMap.values())
+        needFinalName = []
+        for glyphName in self.glyphOrder:
+            if glyphName in finalMap:
+                continue
             if isLegalGlyphName(glyphName):
                 finalMap[glyphName] = glyphName
+                taken.add(glyphName)
+            else:
+                needFinalName.append(glyphName)
         # make names for the rest
+        font = self.font
         for glyphName in needFinalName:
-            if glyphName in finalMap:
-                continue
             uniValue = None
-            if glyphName in self.font:
-                uniValue = self.font[glyphName].unicode
-            finalMap[glyphName] = normalizeGlyphName(glyphName, uniValue, finalMap.values())
+            if glyphName in font:
+                uniValue = font[glyphName].unicode
+            finalName = normalizeGlyphName(glyphName, uniValue, taken)
+            finalMap[glyphName] = finalName
+            taken.add(finalName)
         # done
         return finalMap
 
@@ -84,17 +172,40 @@ class MakeOTFPartsCompiler(object):
         """
         Compile the parts.
         """
-        # set up the parts directory removing
+        # build the parts in a temporary sibling directory
+        # and swap it into place at the end, so a failed
+        # compile can't leave a half-written parts
+        # directory behind. normalize the path first so
+        # that a trailing separator can't land the temp
+        # directory inside the target.
+        path = os.path.normpath(self.path)
+        tempDirectory = path + ".tmp"
+        if os.path.exists(tempDirectory):
+            shutil.rmtree(tempDirectory)
+        os.mkdir(tempDirectory)
+        tempPaths = {
+            name : os.path.join(tempDirectory, os.path.basename(partPath))
+            for name, partPath in self.paths.items()
+        }
+        try:
+            # refresh the fallback cache so that the lookups
+            # reflect the current state of the info object
+            # but are only resolved once per compile
+            self._info = _InfoProxy(self.font.info)
+            # build the parts
+            self.setupFile_outlineSource(tempPaths["outlineSource"])
+            self.setupFile_menuName(tempPaths["menuName"])
+            self.setupFile_glyphOrder(tempPaths["glyphOrder"])
+            self.setupFile_fontInfo(tempPaths["fontInfo"])
+            self.setupFile_features(tempPaths["features"])
+        except Exception:
+            shutil.rmtree(tempDirectory, ignore_errors=True)
+            raise
+        # move the finished parts into place, removing
         # an existing directory if necessary.
-        if os.path.exists(self.path):
-            shutil.rmtree(self.path)
-        os.mkdir(self.path)
-        # build the parts
-        self.setupFile_outlineSource(self.paths["outlineSource"])
-        self.setupFile_menuName(self.paths["menuName"])
-        self.setupFile_glyphOrder(self.paths["glyphOrder"])
-        self.setupFile_fontInfo(self.paths["fontInfo"])
-        self.setupFile_features(self.paths["features"])
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tempDirectory, path)
 
     def setupFile_outlineSource(self, path):
         """
@@ -125,24 +236,24 @@ class MakeOTFPartsCompiler(object):
         may override this method to handle the file creation
         in a different way if desired.
         """
-        psName = getAttrWithFallback(self.font.info, "postscriptFontName")
+        psName = self._info.postscriptFontName
         lines = [
             "[%s]" % psName
         ]
         # family name
-        familyName = getAttrWithFallback(self.font.info, "openTypeNamePreferredFamilyName")
+        familyName = self._info.openTypeNamePreferredFamilyName
         encodedFamilyName = winStr(familyName)
         lines.append("f=%s" % encodedFamilyName)
         if encodedFamilyName != familyName:
             lines.append("f=1,%s" % macStr(familyName))
         # style name
-        styleName = getAttrWithFallback(self.font.info, "openTypeNamePreferredSubfamilyName")
+        styleName = self._info.openTypeNamePreferredSubfamilyName
         encodedStyleName = winStr(styleName)
         lines.append("s=%s" % encodedStyleName)
         if encodedStyleName != styleName:
             lines.append("s=1,%s" % macStr(styleName))
         # compatible name
-        winCompatible = getAttrWithFallback(self.font.info, "styleMapFamilyName")
+        winCompatible = self._info.styleMapFamilyName
         # the second qualification here is in place for Mac Office <= 2004.
         # in that app the menu name is pulled from name ID 18. the font
         # may have standard naming data that combines to a length longer
@@ -154,13 +265,12 @@ class MakeOTFPartsCompiler(object):
             line = "l=%s" % normalizeStringForPostscript(winCompatible)
             lines.append(line)
             # mac
-            macCompatible = getAttrWithFallback(self.font.info, "openTypeNameCompatibleFullName")
+            macCompatible = self._info.openTypeNameCompatibleFullName
             line = "m=1,%s" % macStr(macCompatible)
             lines.append(line)
         text = "\n".join(lines) + "\n"
-        f = open(path, "wb")
-        f.write(toBytes(text))
-        f.close()
+        with open(path, "wb") as f:
+            f.write(toBytes(text))
 
     def setupFile_glyphOrder(self, path):
         """
@@ -170,28 +280,23 @@ class MakeOTFPartsCompiler(object):
         may override this method to handle the file creation
         in a different way if desired.
         """
+        finalNames = self.glyphDesignNameToFinalNameMap
+        font = self.font
         lines = []
         for designName in self.glyphOrder:
-            finalName = self.glyphDesignNameToFinalNameMap[designName]
-            if designName in self.font and self.font[designName].unicode is not None:
-                codes = self.font[designName].unicodes
-                unicodes = []
-                for code in codes:
-                    code = "%04X" % code
-                    if len(code) <= 4:
-                        code = "uni%s" % code
-                    else:
-                        code = "u%s" % code
-                    unicodes.append(code)
-                unicodes = ",".join(unicodes)
+            finalName = finalNames[designName]
+            if designName in font and font[designName].unicode is not None:
+                unicodes = ",".join(
+                    "uni%04X" % code if code <= 0xFFFF else "u%04X" % code
+                    for code in font[designName].unicodes
+                )
                 line = "%s %s %s" % (finalName, designName, unicodes)
             else:
                 line = "%s %s" % (finalName, designName)
             lines.append(line)
         text = "\n".join(lines) + "\n"
-        f = open(path, "wb")
-        f.write(toBytes(text))
-        f.close()
+        with open(path, "wb") as f:
+            f.write(toBytes(text))
 
     def setupFile_fontInfo(self, path):
         """
@@ -212,7 +317,7 @@ class MakeOTFPartsCompiler(object):
         """
         lines = []
         # style mapping
-        styleMapStyleName = getAttrWithFallback(self.font.info, "styleMapStyleName")
+        styleMapStyleName = self._info.styleMapStyleName
         if styleMapStyleName in ("italic", "bold italic"):
             lines.append("IsItalicStyle true")
         else:
@@ -222,7 +327,7 @@ class MakeOTFPartsCompiler(object):
         else:
             lines.append("IsBoldStyle false")
         # fsSelection bits
-        selection = getAttrWithFallback(self.font.info, "openTypeOS2Selection")
+        selection = self._info.openTypeOS2Selection
         if 7 in selection:
             lines.append("PreferOS/2TypoMetrics true")
         else:
@@ -237,9 +342,8 @@ class MakeOTFPartsCompiler(object):
             lines.append("IsOS/2OBLIQUE false")
         # write the file
         if lines:
-            f = open(path, "wb")
-            f.write(toBytes("\n".join(lines)))
-            f.close()
+            with open(path, "wb") as f:
+                f.write(toBytes("\n".join(lines)))
 
     def setupFile_features(self, path):
         """
@@ -266,7 +370,7 @@ class MakeOTFPartsCompiler(object):
             existingFeaturePath = os.path.join(self.font.path, "features.fea")
             existing = forceAbsoluteIncludesInFeatures(self.font.features.text, os.path.dirname(self.font.path))
         # break the features into parts
-        features, tables = extractFeaturesAndTables(existing, scannedFiles=[existingFeaturePath])
+        features, tables = extractFeaturesAndTables(existing, scannedFiles={existingFeaturePath})
         # build tables that are not in the existing features
         autoTables = {}
         if "head" not in tables:
@@ -289,9 +393,8 @@ class MakeOTFPartsCompiler(object):
             features.append(text)
         features = "\n\n".join(features)
         # write the result
-        f = open(path, "wb")
-        f.write(toBytes(features))
-        f.close()
+        with open(path, "wb") as f:
+            f.write(toBytes(features))
 
     def writeFeatures_kern(self):
         """
@@ -319,8 +422,8 @@ class MakeOTFPartsCompiler(object):
         may override this method to handle the string creation
         in a different way if desired.
         """
-        versionMajor = getAttrWithFallback(self.font.info, "versionMajor")
-        versionMinor = getAttrWithFallback(self.font.info, "versionMinor")
+        versionMajor = self._info.versionMajor
+        versionMinor = self._info.versionMinor
         value = "%d.%s" % (versionMajor, str(versionMinor).zfill(3))
         writer = FeatureTableWriter("head")
         writer.addLineWithKeyValue("FontRevision", value)
@@ -344,15 +447,15 @@ class MakeOTFPartsCompiler(object):
         may override this method to handle the string creation
         in a different way if desired.
         """
-        ascender = getAttrWithFallback(self.font.info, "openTypeHheaAscender")
-        descender = getAttrWithFallback(self.font.info, "openTypeHheaDescender")
-        lineGap = getAttrWithFallback(self.font.info, "openTypeHheaLineGap")
-        caret = getAttrWithFallback(self.font.info, "openTypeHheaCaretOffset")
+        info = self._info
+        roundInt = _roundInt
         writer = FeatureTableWriter("hhea")
-        writer.addLineWithKeyValue("Ascender", _roundInt(ascender))
-        writer.addLineWithKeyValue("Descender", _roundInt(descender))
-        writer.addLineWithKeyValue("LineGap", _roundInt(lineGap))
-        writer.addLineWithKeyValue("CaretOffset", _roundInt(caret))
+        writer.addLinesWithKeyValues((
+            ("Ascender", roundInt(info.openTypeHheaAscender)),
+            ("Descender", roundInt(info.openTypeHheaDescender)),
+            ("LineGap", roundInt(info.openTypeHheaLineGap)),
+            ("CaretOffset", roundInt(info.openTypeHheaCaretOffset))
+        ))
         return writer.write()
 
     def writeFeatures_name(self):
@@ -379,29 +482,26 @@ class MakeOTFPartsCompiler(object):
         may override this method to handle the string creation
         in a different way if desired.
         """
-        idToAttr = [
-            (0  , "copyright"),
-            (7  , "trademark"),
-            (8  , "openTypeNameManufacturer"),
-            (9  , "openTypeNameDesigner"),
-            (10 , "openTypeNameDescription"),
-            (11 , "openTypeNameManufacturerURL"),
-            (12 , "openTypeNameDesignerURL"),
-            (13 , "openTypeNameLicense"),
-            (14 , "openTypeNameLicenseURL"),
-            (19 , "openTypeNameSampleText")
-        ]
+        info = self._info
+        values = [(id, getattr(info, attr)) for id, attr in _nameIDToAttr]
+        records = self.font.info.openTypeNameRecords
+        # stripped down fonts often have no naming data
+        # at all, so don't bother encoding anything when
+        # there is nothing to write
+        if not records and all(value is None for id, value in values):
+            return ""
+        win = winStr
+        mac = macStr
         lines = []
-        for id, attr in idToAttr:
-            value = getAttrWithFallback(self.font.info, attr)
+        for id, value in values:
             if value is None:
                 continue
-            s = 'nameid %d "%s";' % (id, winStr(value))
+            s = 'nameid %d "%s";' % (id, win(value))
             lines.append(s)
-            s = 'nameid %d 1 "%s";' % (id, macStr(value))
+            s = 'nameid %d 1 "%s";' % (id, mac(value))
             lines.append(s)
-        if self.font.info.openTypeNameRecords is not None:
-            for record in self.font.info.openTypeNameRecords:
+        if records is not None:
+            for record in records:
                 nameID = record["nameID"]
                 if nameID >= 1 and nameID <= 6:
                     continue
@@ -412,9 +512,9 @@ class MakeOTFPartsCompiler(object):
                 languageID = record["languageID"]
                 string = record["string"]
                 if platformID == 1:
-                    string = macStr(string)
+                    string = mac(string)
                 else:
-                    string = winStr(string)
+                    string = win(string)
                 s = 'nameid %d %d %d %d "%s";' % (nameID, platformID, encodingID, languageID, string)
                 lines.append(s)
         if not lines:
@@ -452,65 +552,40 @@ class MakeOTFPartsCompiler(object):
         may override this method to handle the string creation
         in a different way if desired.
         """
-        codePageBitTranslation = {
-            0  : "1252",
-            1  : "1250",
-            2  : "1251",
-            3  : "1253",
-            4  : "1254",
-            5  : "1255",
-            6  : "1256",
-            7  : "1257",
-            8  : "1258",
-            16 : "874",
-            17 : "932",
-            18 : "936",
-            19 : "949",
-            20 : "950",
-            21 : "1361",
-            48 : "869",
-            49 : "866",
-            50 : "865",
-            51 : "864",
-            52 : "863",
-            53 : "862",
-            54 : "861",
-            55 : "860",
-            56 : "857",
-            57 : "855",
-            58 : "852",
-            59 : "775",
-            60 : "737",
-            61 : "708",
-            62 : "850",
-            63 : "437"
-        }
-        # writer
-        writer = FeatureTableWriter("OS/2")
-        # type
-        writer.addLineWithKeyValue("FSType", intListToNum(getAttrWithFallback(self.font.info, "openTypeOS2Type"), 0, 16))
-        # panose
-        panose = [str(i) for i in getAttrWithFallback(self.font.info, "openTypeOS2Panose")]
-        writer.addLineWithKeyValue("Panose", " ".join(panose))
+        info = self._info
+        roundInt = _roundInt
+        # type and panose
+        pairs = [
+            ("FSType", intListToNum(info.openTypeOS2Type, 0, 16)),
+            ("Panose", " ".join(str(i) for i in info.openTypeOS2Panose))
+        ]
         # unicode ranges
-        unicodeRange = [str(i) for i in getAttrWithFallback(self.font.info, "openTypeOS2UnicodeRanges")]
+        unicodeRange = " ".join(str(i) for i in info.openTypeOS2UnicodeRanges)
         if unicodeRange:
-            writer.addLineWithKeyValue("UnicodeRange", " ".join(unicodeRange))
+            pairs.append(("UnicodeRange", unicodeRange))
         # code page ranges
-        codePageRange = [codePageBitTranslation[i] for i in getAttrWithFallback(self.font.info, "openTypeOS2CodePageRanges") if i in codePageBitTranslation]
+        codePageRange = " ".join(
+            translation for translation in
+            (_codePageBitTranslation[bit] for bit in info.openTypeOS2CodePageRanges if 0 <= bit < 64)
+            if translation is not None
+        )
         if codePageRange:
-            writer.addLineWithKeyValue("CodePageRange", " ".join(codePageRange))
+            pairs.append(("CodePageRange", codePageRange))
         # vertical metrics
-        writer.addLineWithKeyValue("TypoAscender", _roundInt(getAttrWithFallback(self.font.info, "openTypeOS2TypoAscender")))
-        writer.addLineWithKeyValue("TypoDescender", _roundInt(getAttrWithFallback(self.font.info, "openTypeOS2TypoDescender")))
-        writer.addLineWithKeyValue("TypoLineGap", _roundInt(getAttrWithFallback(self.font.info, "openTypeOS2TypoLineGap")))
-        writer.addLineWithKeyValue("winAscent", _roundInt(getAttrWithFallback(self.font.info, "openTypeOS2WinAscent")))
-        writer.addLineWithKeyValue("winDescent", abs(_roundInt(getAttrWithFallback(self.font.info, "openTypeOS2WinDescent"))))
-        writer.addLineWithKeyValue("XHeight", _roundInt(getAttrWithFallback(self.font.info, "xHeight")))
-        writer.addLineWithKeyValue("CapHeight", _roundInt(getAttrWithFallback(self.font.info, "capHeight")))
-        writer.addLineWithKeyValue("WeightClass", getAttrWithFallback(self.font.info, "openTypeOS2WeightClass"))
-        writer.addLineWithKeyValue("WidthClass", getAttrWithFallback(self.font.info, "openTypeOS2WidthClass"))
-        writer.addLineWithKeyValue("Vendor", '"%s"' % getAttrWithFallback(self.font.info, "openTypeOS2VendorID"))
+        pairs += [
+            ("TypoAscender", roundInt(info.openTypeOS2TypoAscender)),
+            ("TypoDescender", roundInt(info.openTypeOS2TypoDescender)),
+            ("TypoLineGap", roundInt(info.openTypeOS2TypoLineGap)),
+            ("winAscent", roundInt(info.openTypeOS2WinAscent)),
+            ("winDescent", abs(roundInt(info.openTypeOS2WinDescent))),
+            ("XHeight", roundInt(info.xHeight)),
+            ("CapHeight", roundInt(info.capHeight)),
+            ("WeightClass", info.openTypeOS2WeightClass),
+            ("WidthClass", info.openTypeOS2WidthClass),
+            ("Vendor", '"%s"' % info.openTypeOS2VendorID)
+        ]
+        writer = FeatureTableWriter("OS/2")
+        writer.addLinesWithKeyValues(pairs)
         return writer.write()
 
 
@@ -518,8 +593,8 @@ class MakeOTFPartsCompiler(object):
 # Glyph Names
 # -----------
 
-_digits = set("0123456789")
-_validCharacters = set("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_.")
+_validCharacters = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_.")
+_illegalCharacterRE = re.compile(r"[^A-Za-z0-9_.]")
 
 
 def isLegalGlyphName(glyphName):
@@ -548,19 +623,16 @@ def isLegalGlyphName(glyphName):
     # must not start with a digit or period
     if not glyphName:
         return False
-    if glyphName[0] in _digits:
+    firstCharacter = glyphName[0]
+    if "0" <= firstCharacter <= "9":
         return False
-    if glyphName[0] == "." and glyphName != ".notdef":
+    if firstCharacter == "." and glyphName != ".notdef":
         return False
     # up to 31 characters in length
     if len(glyphName) > 31:
         return False
     # must be entirely comprised of characters from A-Z a-z 0-9 . _
-    for character in glyphName:
-        if character not in _validCharacters:
-            return False
-    # passed
-    return True
+    return _illegalCharacterRE.search(glyphName) is None
 
 
 def normalizeGlyphName(glyphName, uniValue, existing):
@@ -590,16 +662,15 @@ def normalizeGlyphName(glyphName, uniValue, existing):
     """
     # remove illegal characters
     glyphName = unicodedata.normalize("NFKD", glyphName)
-    glyphName = "".join([c for c in glyphName if c in _validCharacters])
+    glyphName = "".join(filter(_validCharacters.__contains__, glyphName))
     # no new name
     if not glyphName:
         # quickly try to apply the adobe standard
         if uniValue:
             if uniValue > 0x0000 and uniValue < 0xFFFF:
-                prefix = "uni"
+                glyphName = "uni%04X" % uniValue
             else:
-                prefix = "u"
-            glyphName = prefix + hex(uniValue)[2:].zfill(4).upper()
+                glyphName = "u%04X" % uniValue
     # hit test
     if glyphName in existing or not glyphName:
         glyphName = _makeUniqueGlyphName(glyphName, existing)
@@ -617,10 +688,13 @@ def _makeUniqueGlyphName(glyphName, existing, number=1):
     _makeUniqueGlyphName("abc", ["abc"])
     'abc.1'
     """
-    newName = "%s.%d" % (glyphName, number)
-    if newName in existing:
-        return _makeUniqueGlyphName(glyphName, existing, number + 1)
-    return newName
+    # Add an increasing number to the name until
+    # it doesn't clash with an existing name.
+    while True:
+        newName = "%s.%d" % (glyphName, number)
+        if newName not in existing:
+            return newName
+        number += 1
 
 
 def _makeUniqueFallbackGlyphName(existing, number=1):
@@ -630,21 +704,26 @@ def _makeUniqueFallbackGlyphName(existing, number=1):
     >>> _makeUniqueFallbackGlyphName(["glyph1"])
     'glyph2'
     """
-    assert number < 100000  # arbitrary, but come on. 100,000 illegal glyph names?
-    name = "glyph%d" % number
-    if name in existing:
-        return _makeUniqueFallbackGlyphName(existing, number + 1)
-    return name
+    while True:
+        assert number < 100000  # arbitrary, but come on. 100,000 illegal glyph names?
+        name = "glyph%d" % number
+        if name not in existing:
+            return name
+        number += 1
 
 
 # --------
 # Features
 # --------
 
+# feature file syntax is pure ASCII, so compile the
+# patterns with re.ASCII and keep the \s, \S and \d
+# classes on the engine's ASCII fast path.
 includeRE = re.compile(
-    "(include\s*\(\s*)"
-    "([^\)]+)"
-    "(\s*\))"  # this won't actually capture a trailing space.
+    r"(include\s*\(\s*)"
+    r"([^\)]+)"
+    r"(\s*\))",  # this won't actually capture a trailing space.
+    re.ASCII
 )
 
 forceAbsoluteIncludesInFeaturesTestText = """
@@ -691,31 +770,19 @@ def forceAbsoluteIncludesInFeatures(text, directory):
     >>> result == forceAbsoluteIncludesInFeaturesTestResult
     True
     """
-    for match in reversed(list(includeRE.finditer(text))):
+    def replace(match):
         start, includePath, close = match.groups()
         # absolute path
         if os.path.isabs(includePath):
-            continue
-        # relative path
-        currentDirectory = directory
-        parts = includePath.split(os.sep)
-        for index, part in enumerate(parts):
-            part = part.strip()
-            if not part:
-                continue
-            # .. = up one level
-            if part == "..":
-                currentDirectory = os.path.dirname(currentDirectory)
-            # . = current level
-            elif part == ".":
-                continue
-            else:
-                break
-        subPath = os.sep.join(parts[index:])
-        srcPath = os.path.join(currentDirectory, subPath)
-        includeText = start + srcPath + close
-        text = text[:match.start()] + includeText + text[match.end():]
-    return text
+            return match.group(0)
+        # relative path. the trailing whitespace (if any)
+        # is part of the path group, so put it back after
+        # the resolved path.
+        strippedPath = includePath.rstrip()
+        trailingWhitespace = includePath[len(strippedPath):]
+        srcPath = os.path.normpath(os.path.join(directory, strippedPath.strip()))
+        return start + srcPath + trailingWhitespace + close
+    return includeRE.sub(replace, text)
 
 
 def _roundInt(value):
@@ -727,140 +794,248 @@ def _roundInt(value):
 # ----------------------
 
 stringRE = re.compile(
-    "(\"[^$\"]*\")"
+    r"(\"[^$\"]*\")"
+)
+# strings (with escaped quotes handled by the pattern
+# itself) or comments, whichever comes first. the sub
+# call drives the compiled matcher over the whole text
+# in one pass and only calls back into Python at each
+# string or comment, so no scanner machinery is needed
+# on top of it.
+commentStringRE = re.compile(
+    r"(\"(?:\\.|[^\"\\])*\")"
+    r"|"
+    r"(#[^\n]*)"
 )
+stringPlaceholderRE = re.compile(
+    r"__ufo2fdk_temp_string_\d+__",
+    re.ASCII
+)
+# the keywords share one alternation and are anchored
+# to a word boundary, so the engine rejects false starts
+# (e.g. inside rule text) after a single check instead
+# of trying both full branches at every position. block
+# starts can appear mid-line (see the test text below),
+# so the pattern must not be anchored to line starts.
 featureTableStartRE = re.compile(
-    "("
-    "feature"
-    "\s+"
-    "\S{4}"
-    "\s*"
-    "\{"
-    "|"
-    "table"
-    "\s+"
-    "\S{4}"
-    "\s*"
-    "\{"
-    ")",
-    re.MULTILINE
+    r"\b"
+    r"(feature|table)"
+    r"\s+"
+    r"(\S{4})"
+    r"\s*"
+    r"\{",
+    re.MULTILINE | re.ASCII
 )
 featureNameRE = re.compile(
-    "feature"
-    "\s+"
-    "(\S{4})"
-    "\s*"
-    "\{"
+    r"feature"
+    r"\s+"
+    r"(\S{4})"
+    r"\s*"
+    r"\{",
+    re.ASCII
 )
 tableNameRE = re.compile(
-    "table"
-    "\s+"
-    "(\S{4})"
-    "\s*"
-    "\{"
+    r"table"
+    r"\s+"
+    r"(\S{4})"
+    r"\s*"
+    r"\{",
+    re.ASCII
 )
 
 
-def extractFeaturesAndTables(text, scannedFiles=[]):
-    # strip all comments
-    decommentedLines = [line.split("#")[0] for line in text.splitlines()]
-    text = "\n".join(decommentedLines)
-    # replace all strings with temporary placeholders.
-    destringedLines = []
-    stringReplacements = {}
-    for line in text.splitlines():
-        if "\"" in line:
-            line = line.replace("\\\"", "__ufo2fdk_temp_escaped_quote__")
-            for found in stringRE.findall(line):
-                temp = "__ufo2fdk_temp_string_%d__" % len(stringReplacements)
-                line = line.replace(found, temp, 1)
-                stringReplacements[temp] = found.replace("__ufo2fdk_temp_escaped_quote__", "\\\"")
-            line = line.replace("__ufo2fdk_temp_escaped_quote__", "\\\"")
-        destringedLines.append(line)
-    text = "\n".join(destringedLines)
-    # extract all includes
-    includes = []
-    for match in includeRE.finditer(text):
-        start, includePath, close = match.groups()
-        includes.append(includePath)
-    # slice off the text that comes before
-    # the first feature/table definition
-    startMatch = featureTableStartRE.search(text)
-    if startMatch is not None:
-        start, end = startMatch.span()
-        text = text[start:]
-    else:
-        text = ""
-    # break the features
-    broken = _textBreakRecurse(text)
-    # organize into tables and features
-    features = {}
-    tables = {}
-    for text in broken:
-        text = text.strip()
-        if not text:
-            continue
-        # replace the strings
-        finalText = text
-        for temp, original in list(stringReplacements.items()):
-            if temp in finalText:
-                del stringReplacements[temp]
-                finalText = finalText.replace(temp, original, 1)
-        finalText = finalText.strip()
-        # grab feature or table names and store
-        featureMatch = featureNameRE.search(text)
-        if featureMatch is not None:
-            features[featureMatch.group(1)] = finalText
-        else:
-            tableMatch = tableNameRE.search(text)
-            tables[tableMatch.group(1)] = finalText
+def extractFeaturesAndTables(text, scannedFiles=None):
+    """
+    Break *text* into a ``(features, tables)`` pair of
+    dicts mapping each feature or table tag to its full
+    block text. Both dicts preserve source order, so
+    iterating them walks the blocks as they appear in
+    the file.
+    """
+    # when no scanned files are given and the text pulls
+    # in no other files, the result depends only on the
+    # text, so repeated builds of the same features can
+    # reuse the parse. texts with includes read from
+    # disk and must be parsed fresh every time. callers
+    # must treat the returned dicts as read-only. batch
+    # tools that want to parse many fonts in parallel
+    # should fan out at the font level in their own
+    # workers; this function is safe to call from
+    # several processes.
+    if scannedFiles is None:
+        if "include" in text:
+            return _extractFeaturesAndTables(text, set())
+        return _extractFeaturesAndTablesCached(text)
+    return _extractFeaturesAndTables(text, scannedFiles)
+
+
+@functools.lru_cache(maxsize=16)
+def _extractFeaturesAndTablesCached(text):
+    return _extractFeaturesAndTables(text, set())
+
+
+def _extractFeaturesAndTables(text, scannedFiles):
+    # the scanned files are tracked in a set so that
+    # membership tests are cheap and repeated calls
+    # don't share (and silently skip) scanned paths.
+    features, tables, includes = _parseBlocks(text)
     # scan all includes
     for path in includes:
         if path in scannedFiles:
             continue
-        scannedFiles.append(path)
+        scannedFiles.add(path)
         if os.path.exists(path):
-            f = open(path, "r", encoding="utf-8")
-            text = f.read()
-            f.close()
-            f, t = extractFeaturesAndTables(text, scannedFiles)
+            f, t = _loadInclude(path)
             features.update(f)
             tables.update(t)
     return features, tables
 
 
-def _textBreakRecurse(text):
-    matched = []
-    match = featureTableStartRE.search(text)
-    if match is None:
-        matched.append(text)
-    else:
-        start, end = match.span()
-        # add any preceding text to the previous item
-        if start != 0:
-            precedingText = matched.pop(0)
-            precedingText += text[:start]
-            matched.insert(0, precedingText)
-        # look ahead to see if there is another feature
-        next = text[end:]
-        nextMatch = featureTableStartRE.search(next)
-        if nextMatch is None:
-            # if nothing has been found, add
-            # the remaining text to the feature
-            matchedText = text[start:]
-            matched.append(matchedText)
+def _parseBlocks(text):
+    # break *text* into (features, tables, includes)
+    # without touching the file system. the includes
+    # are returned as the raw paths found in the text,
+    # in source order, for the caller to resolve.
+    # empty and trivial feature files are common, so
+    # bail out with plain substring tests before any
+    # pattern work. "include" must be checked too, as
+    # an included file may define blocks even when this
+    # text has none.
+    if "feature" not in text and "table" not in text and "include" not in text:
+        return {}, {}, []
+    # strip all comments and replace all strings with
+    # temporary placeholders in a single pass. escaped
+    # quotes are handled by the pattern, so they don't
+    # need a sentinel round-trip.
+    stringReplacements = {}
+    if "\"" in text or "#" in text:
+
+        def _destring(match):
+            found = match.group(1)
+            if found is None:
+                # a comment
+                return ""
+            temp = "__ufo2fdk_temp_string_%d__" % len(stringReplacements)
+            stringReplacements[temp] = found
+            return temp
+
+        text = commentStringRE.sub(_destring, text)
+    # extract all includes
+    includes = [match.group(2) for match in includeRE.finditer(text)]
+    # break the features into (start, end) spans, one
+    # per feature/table block. the text that comes
+    # before the first definition falls outside every
+    # span, and only each block's own bytes are copied
+    # out of the text, so the total copied is bounded
+    # by the size of the text itself.
+    features = {}
+    tables = {}
+    buckets = {"feature": features, "table": tables}
+    for keyword, tag, spanStart, spanEnd in _findBlockSpans(text):
+        blockText = text[spanStart:spanEnd].strip()
+        # replace the strings. each placeholder is put
+        # back with one substitution pass instead of
+        # scanning the text for every stored string.
+        if stringReplacements:
+            finalText = stringPlaceholderRE.sub(
+                lambda match: stringReplacements.get(match.group(0), match.group(0)),
+                blockText
+            ).strip()
         else:
-            # if one has been found, grab all text
-            # from before the feature start and add
-            # it to the current feature.
-            nextStart, nextEnd = nextMatch.span()
-            matchedText = text[:end + nextStart]
-            matched.append(matchedText)
-            # recurse through the remaining text
-            matched += _textBreakRecurse(next[nextStart:])
-    return matched
+            finalText = blockText
+        # the keyword and tag were captured by the start
+        # pattern, so classification is a dict lookup
+        # instead of a second search over the block. the
+        # tags repeat across every font in a batch, so
+        # intern them to share one string object per tag.
+        buckets[keyword][sys.intern(tag)] = finalText
+    return features, tables, includes
+
+
+_includeCache = {}
+_includesInProgress = set()
+
+
+def _loadInclude(path):
+    """
+    Parse an included feature file. Only the tokenizing
+    of the file itself is memoized, keyed on the file's
+    absolute path and modification time; the include
+    graph below it is walked again on every call so
+    that an edit anywhere in a chain of includes is
+    always picked up.
+    """
+    absPath = os.path.abspath(path)
+    if absPath in _includesInProgress:
+        # a circular include. skip it, as a shared
+        # scanned set would have.
+        return {}, {}
+    key = (absPath, os.path.getmtime(path))
+    parsed = _includeCache.get(key)
+    if parsed is None:
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        parsed = _parseBlocks(text)
+        # entries for older modification times of the
+        # same file can never be hit again, so drop
+        # them instead of letting the cache grow with
+        # every edit.
+        for oldKey in [cachedKey for cachedKey in _includeCache if cachedKey[0] == absPath]:
+            del _includeCache[oldKey]
+        _includeCache[key] = parsed
+    fileFeatures, fileTables, includes = parsed
+    # the cached dicts are shared between calls, so
+    # merge into fresh copies.
+    features = dict(fileFeatures)
+    tables = dict(fileTables)
+    _includesInProgress.add(absPath)
+    try:
+        scanned = {path}
+        for includePath in includes:
+            if includePath in scanned:
+                continue
+            scanned.add(includePath)
+            if os.path.exists(includePath):
+                f, t = _loadInclude(includePath)
+                features.update(f)
+                tables.update(t)
+    finally:
+        _includesInProgress.discard(absPath)
+    return features, tables
 
 
+def _findBlockSpans(text):
+    # find every feature/table start in one scan and
+    # yield (keyword, tag, start, end) tuples, with the
+    # indexes running from each start to the next. as a
+    # generator, this never builds an intermediate list
+    # of spans; the parse loop consumes each block as
+    # it is found. the
+    # character-level scanning all happens inside the
+    # compiled pattern, so the interpreter only runs
+    # once per block, not once per character. finditer
+    # resumes from each match position in the original
+    # buffer, so no tail slices are ever made, and the
+    # caller slices the blocks out lazily, so the text
+    # itself is never copied here. note that blocks are
+    # deliberately not brace matched: comments and
+    # strings are masked before this runs, so braces
+    # inside them can't mislead the start pattern, and
+    # the closing "} tag;" plus any trailing text must
+    # stay attached to the block that precedes it.
+    previous = None
+    for match in featureTableStartRE.finditer(text):
+        start = match.start()
+        if previous is not None:
+            yield previous + (start,)
+        previous = (match.group(1), match.group(2), start)
+    if previous is not None:
+        yield previous + (len(text),)
+
+
+# the test fixtures live at module level so that
+# doctest (and pytest --doctest-modules) can find
+# them; they total well under a kilobyte.
 extractFeaturesAndTablesTestText = """
 @foo = [bar];
 